@@ -4,19 +4,40 @@ Applies prettymaps-inspired styling to any OSM polygon and line layers
 Works with any location - not just Times Square!
 """
 
+import hashlib
+
 from qgis.core import (
     QgsProcessing,
     QgsProcessingAlgorithm,
     QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterBoolean,
     QgsProcessingParameterFeatureSink,
     QgsSymbol,
+    QgsSymbolLayer,
+    QgsProperty,
     QgsRuleBasedRenderer,
+    QgsCategorizedSymbolRenderer,
+    QgsRendererCategory,
     QgsProject,
+    QgsSettings,
+    QgsWkbTypes,
     QgsProcessingException
 )
 from qgis.PyQt.QtGui import QColor
 from qgis.PyQt.QtCore import Qt, QCoreApplication
 
+
+def _in_filter(conditions):
+    """
+    Build a filter expression from a {field: [values]} mapping,
+    using one IN list per field and OR only across fields
+    """
+    return ' OR '.join(
+        '"{}" IN ({})'.format(field, ','.join(f"'{value}'" for value in values))
+        for field, values in conditions.items()
+    )
+
+
 class StyleOSMMapAlgorithm(QgsProcessingAlgorithm):
     """
     Processing algorithm to apply prettymaps styling to OSM layers from any location
@@ -25,6 +46,70 @@ class StyleOSMMapAlgorithm(QgsProcessingAlgorithm):
     # Parameter names
     POLYGON_LAYER = 'POLYGON_LAYER'
     LINE_LAYER = 'LINE_LAYER'
+    FORCE_RESTYLE = 'FORCE_RESTYLE'
+    
+    # Custom properties tagging layers styled by this algorithm
+    SIGNATURE_PROPERTY = 'prettymaps/signature'
+    SOURCE_PROPERTY = 'prettymaps/source'
+    SIZE_PROPERTY = 'prettymaps/size'
+    
+    # Polygon filters - built once at import, they do not depend on inputs
+    _GREEN_FILTER = _in_filter({
+        'landuse': ['grass', 'meadow', 'recreation_ground'],
+        'leisure': ['park', 'garden'],
+        'natural': ['island', 'wood', 'grassland']
+    })
+    _FOREST_FILTER = _in_filter({
+        'landuse': ['forest'],
+        'natural': ['tree_row', 'scrub']
+    })
+    _WATER_FILTER = _in_filter({
+        'natural': ['water', 'bay'],
+        'waterway': ['river', 'stream', 'canal', 'drain'],
+        'landuse': ['reservoir', 'basin']
+    })
+    _PARKING_FILTER = _in_filter({
+        'amenity': ['parking'],
+        'highway': ['pedestrian', 'footway'],
+        'man_made': ['pier'],
+        'leisure': ['plaza'],
+        'place': ['square']
+    })
+    # Shapefile/DBF inputs store a missing tag as '' rather than NULL, so both
+    # are excluded; NULL NOT IN (...) evaluates to NULL (false), so untagged
+    # features are excluded without a separate IS NOT NULL clause
+    _BUILDING_FILTER = '"building" NOT IN (\'no\',\'\')'
+    
+    # Street widths keyed by "highway" value; '' is the catch-all category.
+    # Roads listed in _LINKED_ROADS also get a '<road>_link' category
+    _ROAD_WIDTHS = {
+        'motorway': 1.2,
+        'trunk': 1.1,
+        'primary': 1.0,
+        'secondary': 0.9,
+        'tertiary': 0.8,
+        'residential': 0.6,
+        'unclassified': 0.5,
+        'living_street': 0.5,
+        'service': 0.4,
+        'pedestrian': 0.4,
+        'footway': 0.3,
+        'path': 0.3,
+        'cycleway': 0.3,
+        'track': 0.3,
+        '': 0.3
+    }
+    _LINKED_ROADS = ('motorway', 'trunk', 'primary', 'secondary', 'tertiary')
+    # A NULL "highway" would fall into the '' catch-all, so lines without the
+    # tag (railways, waterways, boundaries) are mapped to a hidden category
+    _UNTAGGED_ROAD = '__untagged__'
+    
+    # Symbol settings shared by the generated styles
+    _OUTLINE_WIDTH = 0.3
+    _OUTLINE_STYLE = Qt.SolidLine
+    _BUILDING_OUTLINE_WIDTH = 0.15
+    _STREET_CAP_STYLE = Qt.RoundCap
+    _STREET_JOIN_STYLE = Qt.RoundJoin
     
     def initAlgorithm(self, config=None):
         """
@@ -48,6 +133,16 @@ class StyleOSMMapAlgorithm(QgsProcessingAlgorithm):
                 [QgsProcessing.TypeVectorLine]
             )
         )
+        
+        # Rebuild even when the layers already carry this style, e.g. to
+        # reset changes made in Layer Properties
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.FORCE_RESTYLE,
+                'Rebuild styles even if the layers are already styled',
+                defaultValue=False
+            )
+        )
     
     def processAlgorithm(self, parameters, context, feedback):
         """
@@ -64,6 +159,15 @@ class StyleOSMMapAlgorithm(QgsProcessingAlgorithm):
         feedback.pushInfo(f'Styling polygon layer: {polygon_layer.name()}')
         feedback.pushInfo(f'Styling line layer: {line_layer.name()}')
         
+        # Providers (PostGIS, GeoPackage) only evaluate the filters server-side
+        # when expression compilation is on; leave the user's choice alone
+        if not QgsSettings().value('qgis/compileExpressions', True, bool):
+            feedback.reportError(
+                'Expression compilation is disabled in QGIS settings; '
+                'filters will be evaluated locally instead of by the data provider',
+                fatalError=False
+            )
+        
         # Color definitions matching prettymaps style
         colors = {
             'background': '#F2F4CB',
@@ -76,18 +180,45 @@ class StyleOSMMapAlgorithm(QgsProcessingAlgorithm):
             'edge': '#2F3737'
         }
         
-        # ========== STYLE POLYGON LAYER ==========
-        feedback.pushInfo('\n--- Styling Polygons ---')
-        self.style_polygons(polygon_layer, colors, feedback)
+        # Parse the hex strings once and reuse the QColor instances everywhere
+        qcolors = {key: QColor(value) for key, value in colors.items() if isinstance(value, str)}
+        qcolors['building_palette'] = [QColor(color) for color in colors['building_palette']]
         
-        # ========== STYLE LINE LAYER ==========
-        feedback.pushInfo('\n--- Styling Lines ---')
-        self.style_lines(line_layer, colors, feedback)
+        # Skip rebuilding when both layers still carry the renderers from a
+        # previous run with the same style inputs on the same data sources
+        signature = self._style_signature(colors, self._building_id_expr(polygon_layer.fields()))
+        restyle = (
+            self.parameterAsBoolean(parameters, self.FORCE_RESTYLE, context)
+            or not self._is_styled(polygon_layer, 'RuleRenderer', signature)
+            or not self._is_styled(line_layer, 'categorizedSymbol', signature)
+        )
+        if restyle:
+            # ========== STYLE POLYGON LAYER ==========
+            feedback.pushInfo('\n--- Styling Polygons ---')
+            polygon_renderer = self._build_polygon_renderer(polygon_layer.fields(), qcolors)
+            polygon_layer.setRenderer(polygon_renderer)
+            feedback.pushInfo(f'  ✓ Applied {len(polygon_renderer.rootRule().children())} polygon rules')
+            
+            # ========== STYLE LINE LAYER ==========
+            feedback.pushInfo('\n--- Styling Lines ---')
+            line_renderer = self._build_line_renderer(qcolors)
+            line_layer.setRenderer(line_renderer)
+            feedback.pushInfo(f'  ✓ Applied {len(line_renderer.categories())} line categories')
+            
+            self._mark_styled(polygon_layer, signature)
+            self._mark_styled(line_layer, signature)
+        else:
+            feedback.pushInfo('\nLayers already styled, skipping renderer rebuild')
         
-        # Set canvas background
-        canvas = context.project().mapCanvas() if hasattr(context.project(), 'mapCanvas') else None
+        # Set canvas background, then repaint both layers in a single pass
+        project = context.project()
+        canvas = getattr(project, 'mapCanvas', lambda: None)()
+        if canvas:
+            canvas.setCanvasColor(qcolors['background'])
+        if restyle:
+            polygon_layer.triggerRepaint()
+            line_layer.triggerRepaint()
         if canvas:
-            canvas.setCanvasColor(QColor(colors['background']))
             canvas.refresh()
         
         feedback.pushInfo('\n' + '='*50)
@@ -100,153 +231,171 @@ class StyleOSMMapAlgorithm(QgsProcessingAlgorithm):
             'LINE_LAYER': line_layer.name()
         }
     
-    def style_polygons(self, layer, colors, feedback):
+    def _build_polygon_renderer(self, fields, qcolors):
         """
-        Apply styling rules to polygon layer
+        Build the rule-based renderer for the polygon layer
         """
         
         # Create rule-based renderer
         root_rule = QgsRuleBasedRenderer.Rule(None)
         
+        # Configure the outline once, then clone the symbol per category
+        poly_symbol = self._make_poly_symbol(qcolors['green'], qcolors['edge'])
+        
         # GREEN SPACES - flexible attribute checking
-        green_conditions = [
-            '"landuse" = \'grass\'',
-            '"leisure" = \'park\'',
-            '"leisure" = \'garden\'',
-            '"natural" = \'island\'',
-            '"natural" = \'wood\'',
-            '"natural" = \'grassland\'',
-            '"landuse" = \'meadow\'',
-            '"landuse" = \'recreation_ground\''
-        ]
-        green_filter = ' OR '.join(green_conditions)
-        green_symbol = QgsSymbol.defaultSymbol(2)
-        green_symbol.setColor(QColor(colors['green']))
-        green_symbol.symbolLayer(0).setStrokeColor(QColor(colors['edge']))
-        green_symbol.symbolLayer(0).setStrokeWidth(0.3)
-        green_symbol.symbolLayer(0).setStrokeStyle(Qt.SolidLine)
-        root_rule.appendChild(QgsRuleBasedRenderer.Rule(green_symbol, 0, 0, green_filter, 'Green Spaces'))
+        green_symbol = poly_symbol.clone()
+        green_symbol.setColor(qcolors['green'])
+        root_rule.appendChild(QgsRuleBasedRenderer.Rule(green_symbol, 0, 0, self._GREEN_FILTER, 'Green Spaces'))
         
         # FOREST
-        forest_conditions = [
-            '"landuse" = \'forest\'',
-            '"natural" = \'tree_row\'',
-            '"natural" = \'scrub\''
-        ]
-        forest_filter = ' OR '.join(forest_conditions)
-        forest_symbol = QgsSymbol.defaultSymbol(2)
-        forest_symbol.setColor(QColor(colors['forest']))
-        forest_symbol.symbolLayer(0).setStrokeColor(QColor(colors['edge']))
-        forest_symbol.symbolLayer(0).setStrokeWidth(0.3)
-        forest_symbol.symbolLayer(0).setStrokeStyle(Qt.SolidLine)
-        root_rule.appendChild(QgsRuleBasedRenderer.Rule(forest_symbol, 0, 0, forest_filter, 'Forest'))
+        forest_symbol = poly_symbol.clone()
+        forest_symbol.setColor(qcolors['forest'])
+        root_rule.appendChild(QgsRuleBasedRenderer.Rule(forest_symbol, 0, 0, self._FOREST_FILTER, 'Forest'))
         
         # WATER
-        water_conditions = [
-            '"natural" = \'water\'',
-            '"natural" = \'bay\'',
-            '"waterway" = \'river\'',
-            '"waterway" = \'stream\'',
-            '"waterway" = \'canal\'',
-            '"waterway" = \'drain\'',
-            '"landuse" = \'reservoir\'',
-            '"landuse" = \'basin\''
-        ]
-        water_filter = ' OR '.join(water_conditions)
-        water_symbol = QgsSymbol.defaultSymbol(2)
-        water_symbol.setColor(QColor(colors['water']))
-        water_symbol.symbolLayer(0).setStrokeColor(QColor(colors['edge']))
-        water_symbol.symbolLayer(0).setStrokeWidth(0.3)
-        water_symbol.symbolLayer(0).setStrokeStyle(Qt.SolidLine)
-        root_rule.appendChild(QgsRuleBasedRenderer.Rule(water_symbol, 0, 0, water_filter, 'Water'))
+        water_symbol = poly_symbol.clone()
+        water_symbol.setColor(qcolors['water'])
+        root_rule.appendChild(QgsRuleBasedRenderer.Rule(water_symbol, 0, 0, self._WATER_FILTER, 'Water'))
         
         # PARKING / PEDESTRIAN / PLAZAS
-        parking_conditions = [
-            '"amenity" = \'parking\'',
-            '"highway" = \'pedestrian\'',
-            '"highway" = \'footway\'',
-            '"man_made" = \'pier\'',
-            '"leisure" = \'plaza\'',
-            '"place" = \'square\''
-        ]
-        parking_filter = ' OR '.join(parking_conditions)
-        parking_symbol = QgsSymbol.defaultSymbol(2)
-        parking_symbol.setColor(QColor(colors['parking']))
-        parking_symbol.symbolLayer(0).setStrokeColor(QColor(colors['edge']))
-        parking_symbol.symbolLayer(0).setStrokeWidth(0.3)
-        parking_symbol.symbolLayer(0).setStrokeStyle(Qt.SolidLine)
-        root_rule.appendChild(QgsRuleBasedRenderer.Rule(parking_symbol, 0, 0, parking_filter, 'Parking/Pedestrian'))
+        parking_symbol = poly_symbol.clone()
+        parking_symbol.setColor(qcolors['parking'])
+        root_rule.appendChild(QgsRuleBasedRenderer.Rule(parking_symbol, 0, 0, self._PARKING_FILTER, 'Parking/Pedestrian'))
         
-        # BUILDINGS (3-color palette) - flexible building detection
-        building_conditions = [
-            '"building" IS NOT NULL',
-            '"building" != \'no\'',
-            '"building" != \'\''
-        ]
-        building_filter = ' AND '.join(building_conditions)
+        # BUILDINGS (3-color palette)
+        # Use fid or osm_id for color distribution - works with any layer
+        id_expr = self._building_id_expr(fields)
         
-        for i, color in enumerate(colors['building_palette']):
-            building_symbol = QgsSymbol.defaultSymbol(2)
-            building_symbol.setColor(QColor(color))
-            building_symbol.symbolLayer(0).setStrokeColor(QColor(colors['edge']))
-            building_symbol.symbolLayer(0).setStrokeWidth(0.15)
-            # Use fid or osm_id for color distribution - works with any layer
-            if 'osm_id' in [field.name() for field in layer.fields()]:
-                building_sub_filter = f'({building_filter}) AND ("osm_id" % 3 = {i})'
-            elif 'fid' in [field.name() for field in layer.fields()]:
-                building_sub_filter = f'({building_filter}) AND ("fid" % 3 = {i})'
-            else:
-                building_sub_filter = f'({building_filter}) AND ($id % 3 = {i})'
-            root_rule.appendChild(QgsRuleBasedRenderer.Rule(building_symbol, 0, 0, building_sub_filter, f'Buildings {i+1}'))
-        
-        # Apply renderer
-        renderer = QgsRuleBasedRenderer(root_rule)
-        layer.setRenderer(renderer)
-        layer.triggerRepaint()
+        # Single rule, palette picked per feature by a data-defined fill color
+        palette = qcolors['building_palette']
+        palette_cases = ' '.join(
+            f"WHEN {id_expr} % {len(palette)} = {i} THEN '{color.name()}'"
+            for i, color in enumerate(palette)
+        )
+        building_symbol = poly_symbol.clone()
+        building_symbol.setColor(palette[0])
+        building_symbol_layer = building_symbol.symbolLayer(0)
+        building_symbol_layer.setStrokeWidth(self._BUILDING_OUTLINE_WIDTH)
+        building_symbol_layer.setDataDefinedProperty(
+            QgsSymbolLayer.PropertyFillColor,
+            QgsProperty.fromExpression(f'CASE {palette_cases} END')
+        )
+        root_rule.appendChild(QgsRuleBasedRenderer.Rule(building_symbol, 0, 0, self._BUILDING_FILTER, 'Buildings'))
         
-        feedback.pushInfo(f'  ✓ Applied {len(root_rule.children())} polygon rules')
+        return QgsRuleBasedRenderer(root_rule)
     
-    def style_lines(self, layer, colors, feedback):
+    def _build_line_renderer(self, qcolors):
         """
-        Apply styling rules to line layer (streets)
+        Build the categorized renderer for the line layer (streets)
         """
         
-        # Create rule-based renderer
-        root_rule = QgsRuleBasedRenderer.Rule(None)
-        
-        # Define road styles - comprehensive road types
-        road_styles = [
-            ('motorway', 1.2, '"highway" = \'motorway\' OR "highway" = \'motorway_link\''),
-            ('trunk', 1.1, '"highway" = \'trunk\' OR "highway" = \'trunk_link\''),
-            ('primary', 1.0, '"highway" = \'primary\' OR "highway" = \'primary_link\''),
-            ('secondary', 0.9, '"highway" = \'secondary\' OR "highway" = \'secondary_link\''),
-            ('tertiary', 0.8, '"highway" = \'tertiary\' OR "highway" = \'tertiary_link\''),
-            ('residential', 0.6, '"highway" = \'residential\''),
-            ('service', 0.4, '"highway" = \'service\''),
-            ('unclassified', 0.5, '"highway" = \'unclassified\''),
-            ('living_street', 0.5, '"highway" = \'living_street\''),
-            ('pedestrian', 0.4, '"highway" = \'pedestrian\''),
-            ('footway', 0.3, '"highway" = \'footway\' OR "highway" = \'path\''),
-            ('cycleway', 0.3, '"highway" = \'cycleway\''),
-            ('track', 0.3, '"highway" = \'track\''),
-            ('other', 0.3, '"highway" IS NOT NULL')
-        ]
+        # One category per highway value: features are matched by a hash
+        # lookup on the attribute instead of testing a filter per road type.
+        # Configure the street symbol once, then clone it per category
+        street_symbol = self._make_line_symbol(qcolors['streets'], self._ROAD_WIDTHS[''])
+        categories = []
+        for value, width in self._ROAD_WIDTHS.items():
+            road_symbol = street_symbol.clone()
+            road_symbol.setWidth(width)
+            categories.append(QgsRendererCategory(value, road_symbol, f'Street - {value or "other"}'))
+            # Link roads share the width of the road class they connect to
+            if value in self._LINKED_ROADS:
+                categories.append(QgsRendererCategory(f'{value}_link', road_symbol.clone(), f'Street - {value}_link'))
+        categories.append(QgsRendererCategory(self._UNTAGGED_ROAD, street_symbol.clone(), 'Not a street', False))
         
-        for road_name, width, filter_expr in road_styles:
-            street_symbol = QgsSymbol.defaultSymbol(1)
-            street_symbol.setColor(QColor(colors['streets']))
-            street_symbol.setWidth(width)
-            street_symbol.symbolLayer(0).setPenCapStyle(Qt.RoundCap)
-            street_symbol.symbolLayer(0).setPenJoinStyle(Qt.RoundJoin)
-            
-            root_rule.appendChild(QgsRuleBasedRenderer.Rule(street_symbol, 0, 0, filter_expr, f'Street - {road_name}'))
-        
-        # Apply renderer
-        renderer = QgsRuleBasedRenderer(root_rule)
-        layer.setRenderer(renderer)
-        layer.triggerRepaint()
-        
-        feedback.pushInfo(f'  ✓ Applied {len(root_rule.children())} line rules')
+        return QgsCategorizedSymbolRenderer(f'coalesce("highway", \'{self._UNTAGGED_ROAD}\')', categories)
+    
+    @staticmethod
+    def _building_id_expr(fields):
+        """
+        Returns the id expression used to spread the building palette:
+        osm_id or fid when the layer has them, the feature id otherwise
+        """
+        if fields.indexOf('osm_id') >= 0:
+            return '"osm_id"'
+        if fields.indexOf('fid') >= 0:
+            return '"fid"'
+        return '$id'
+    
+    def _style_signature(self, colors, id_expr):
+        """
+        Returns a hash of the colors, filters, street widths, symbol settings
+        and building id expression, so changing any of them invalidates it
+        """
+        style_inputs = (
+            sorted(colors.items()),
+            id_expr,
+            self._GREEN_FILTER,
+            self._FOREST_FILTER,
+            self._WATER_FILTER,
+            self._PARKING_FILTER,
+            self._BUILDING_FILTER,
+            sorted(self._ROAD_WIDTHS.items()),
+            self._LINKED_ROADS,
+            self._UNTAGGED_ROAD,
+            self._OUTLINE_WIDTH,
+            self._OUTLINE_STYLE,
+            self._BUILDING_OUTLINE_WIDTH,
+            self._STREET_CAP_STYLE,
+            self._STREET_JOIN_STYLE
+        )
+        return hashlib.sha1(repr(style_inputs).encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def _renderer_size(renderer):
+        """
+        Returns the number of categories or top-level rules of a renderer
+        """
+        if renderer.type() == 'categorizedSymbol':
+            return len(renderer.categories())
+        return len(renderer.rootRule().children())
+    
+    def _is_styled(self, layer, renderer_type, signature):
+        """
+        Returns True if the layer still carries the renderer applied by a
+        previous run with the same signature on the same data source
+        """
+        renderer = layer.renderer()
+        return (
+            renderer is not None
+            and renderer.type() == renderer_type
+            and layer.customProperty(self.SIGNATURE_PROPERTY) == signature
+            and layer.customProperty(self.SOURCE_PROPERTY) == layer.dataProvider().dataSourceUri()
+            and str(layer.customProperty(self.SIZE_PROPERTY)) == str(self._renderer_size(renderer))
+        )
+    
+    def _mark_styled(self, layer, signature):
+        """
+        Tag the layer with the style signature, its data source and the
+        size of the renderer just applied
+        """
+        layer.setCustomProperty(self.SIGNATURE_PROPERTY, signature)
+        layer.setCustomProperty(self.SOURCE_PROPERTY, layer.dataProvider().dataSourceUri())
+        layer.setCustomProperty(self.SIZE_PROPERTY, str(self._renderer_size(layer.renderer())))
+    
+    def _make_poly_symbol(self, fill_qcolor, edge_qcolor, stroke_width=_OUTLINE_WIDTH):
+        """
+        Returns a fill symbol with the given fill color and solid outline
+        """
+        symbol = QgsSymbol.defaultSymbol(QgsWkbTypes.PolygonGeometry)
+        symbol.setColor(fill_qcolor)
+        symbol_layer = symbol.symbolLayer(0)
+        symbol_layer.setStrokeColor(edge_qcolor)
+        symbol_layer.setStrokeWidth(stroke_width)
+        symbol_layer.setStrokeStyle(self._OUTLINE_STYLE)
+        return symbol
+    
+    def _make_line_symbol(self, color_qcolor, width):
+        """
+        Returns a line symbol with round caps and joins
+        """
+        symbol = QgsSymbol.defaultSymbol(QgsWkbTypes.LineGeometry)
+        symbol.setColor(color_qcolor)
+        symbol.setWidth(width)
+        symbol_layer = symbol.symbolLayer(0)
+        symbol_layer.setPenCapStyle(self._STREET_CAP_STYLE)
+        symbol_layer.setPenJoinStyle(self._STREET_JOIN_STYLE)
+        return symbol
     
     def name(self):
         """
@@ -281,7 +430,9 @@ class StyleOSMMapAlgorithm(QgsProcessingAlgorithm):
         
         This algorithm styles:
         - Polygon layer: Buildings (3-color palette), parks, water, forests, parking, plazas
-        - Line layer: Streets with varying widths based on road type (14 road types)
+        - Line layer: Streets with varying widths based on the highway tag
+          (20 categories: 15 road types plus *_link ramps for motorway,
+          trunk, primary, secondary and tertiary); untagged lines are hidden
         
         Works with OSM data from anywhere in the world!
         